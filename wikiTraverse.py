@@ -1,7 +1,263 @@
 import requests
-from bs4 import BeautifulSoup
 import spacy
-from time import sleep
+import numpy as np
+from time import sleep, monotonic, time
+import shelve
+import dbm
+import re
+import os
+from urllib.parse import quote, unquote
+
+# Only the word vectors are used, so the medium package is enough
+# and none of its pipeline components need to be loaded
+MODEL = "en_core_web_md"
+nlp = spacy.load(MODEL, exclude=[
+  "tok2vec", "tagger", "parser", "attribute_ruler", "lemmatizer", "ner", "senter"])
+
+# The vector table is quantized to int8, with one float scale per row,
+# and saved to .npy files once. From then on the files are memory-mapped,
+# so processes running traversals side by side share a single copy
+# (a quarter the size of the float table) through the OS page cache
+VECTORS_PATH = MODEL + "-" + nlp.meta["version"] + ".vectors.int8.npy"
+SCALES_PATH = MODEL + "-" + nlp.meta["version"] + ".scales.npy"
+
+# Writes to a temporary file first and renames it into place, so
+# another process never loads a half-written file and an interrupted
+# run leaves nothing behind
+def saveArray(path, array):
+  tempPath = path + "." + str(os.getpid()) + ".tmp"
+  with open(tempPath, "wb") as file:
+    np.save(file, array)
+  os.replace(tempPath, path)
+
+# The scales are saved first, so once the vectors file exists
+# both files are complete
+def saveQuantizedVectors(table):
+  scales = np.abs(table).max(axis=1) / 127
+  scales[scales == 0] = 1
+  saveArray(SCALES_PATH, scales.astype(np.float32))
+  saveArray(VECTORS_PATH, np.round(table / scales[:, None]).astype(np.int8))
+
+if not os.path.exists(VECTORS_PATH):
+  saveQuantizedVectors(nlp.vocab.vectors.data)
+VECTOR_TABLE = np.load(VECTORS_PATH, mmap_mode="r")
+VECTOR_SCALES = np.load(SCALES_PATH, mmap_mode="r")
+# Only the string hashes and the key -> row mapping are still read
+# from spaCy. Dropping the rest lets its float copy of the table go
+STRINGS = nlp.vocab.strings
+KEY2ROW = nlp.vocab.vectors.key2row
+del nlp
+
+# One session for every request so the connection to Wikipedia
+# stays open between pages instead of reconnecting on each hop
+SESSION = requests.Session()
+SESSION.headers["User-Agent"] = "wikipedia-traverse (python-requests)"
+
+# Wikipedia asks crawlers not to hammer it, so requests are spaced
+# at least MIN_REQUEST_INTERVAL seconds apart. Time spent scoring
+# counts towards the gap, so we only sleep for whatever is left
+MIN_REQUEST_INTERVAL = 1
+nextRequestTime = 0.0
+
+def waitForRequestSlot():
+  global nextRequestTime
+  sleep(max(0, nextRequestTime - monotonic()))
+  nextRequestTime = monotonic() + MIN_REQUEST_INTERVAL
+
+# Link lists of pages we've already looked up are kept on disk
+# between runs as url -> (time saved, [(link URL, link title), ...]).
+# Article links change on the order of days, so a list is used as is
+# for LINK_CACHE_SECONDS before the page is looked up again. Cached
+# pages make no request, so they don't wait on the rate limit either.
+# Several processes may share the file: lookups open it read-only,
+# and if another process has it locked the cache is simply skipped.
+# Only the gdbm backend locks the file; with ndbm or the dumb backend
+# run one traversal at a time
+LINK_CACHE_PATH = "wiki_link_lists.db"
+LINK_CACHE_SECONDS = 24 * 60 * 60
+cachePruned = False
+
+# Returns {url: link list} for the urls with a fresh cache entry
+def readCachedLinks(urls):
+  links = {}
+  try:
+    with shelve.open(LINK_CACHE_PATH, flag="r") as cache:
+      for url in urls:
+        cached = cache.get(url)
+        if cached and time() - cached[0] < LINK_CACHE_SECONDS:
+          links[url] = cached[1]
+  except dbm.error:
+    # No cache file yet, or another process is writing to it
+    pass
+  return links
+
+# Stores {url: link list} in the cache. The first write of a process
+# also removes expired entries so the file doesn't grow forever
+def writeCachedLinks(links):
+  global cachePruned
+  savedAt = time()
+  try:
+    with shelve.open(LINK_CACHE_PATH) as cache:
+      if not cachePruned:
+        for url in list(cache.keys()):
+          if savedAt - cache[url][0] >= LINK_CACHE_SECONDS:
+            del cache[url]
+        cachePruned = True
+      for url, pageLinks in links.items():
+        cache[url] = (savedAt, pageLinks)
+  except dbm.error:
+    # Another process holds the cache; these pages just aren't cached
+    pass
+
+API_URL = "https://en.wikipedia.org/w/api.php"
+
+# Article URLs are turned into titles and back so that every URL we
+# compare is spelled the same way. A URL copied from a browser may be
+# percent-encoded (Beyonc%C3%A9), and titles can contain "/" (AC/DC),
+# so the title is everything after /wiki/, not just the last segment
+def urlToTitle(url):
+  return unquote(url.split("/wiki/", 1)[1]).replace("_", " ")
+
+def titleToURL(title):
+  return "https://en.wikipedia.org/wiki/" + quote(title.replace(" ", "_"), safe="/:(),'!*")
+
+# Link titles repeat constantly across pages ("United States", etc.),
+# so each title's vector is only looked up once per process. Vectors
+# are stored normalized to length 1, which makes cosine similarity
+# a plain dot product. Ranking links doesn't need full precision,
+# so they are kept as float16 to halve the memory the cache takes up.
+# Once it holds TITLE_CACHE_SIZE titles it starts over
+TITLE_CACHE_SIZE = 100000
+titleVectors = {}
+
+# A title's vector is the average of its words' vectors, read
+# straight from the vector table. This skips the tokenizer and
+# the tagger/parser/NER pipeline, none of which we need.
+# Words without a vector are left out of the average
+def titleRows(title):
+  rows = []
+  for word in re.findall(r"\w+", title):
+    row = KEY2ROW.get(STRINGS[word], -1)
+    if row < 0:
+      row = KEY2ROW.get(STRINGS[word.lower()], -1)
+    if row >= 0:
+      rows.append(row)
+  return rows
+
+# Returns an (N, 300) matrix holding the unit vector of each title.
+# Titles we haven't seen yet are handled all together: their rows
+# are gathered in one go and np.add.reduceat sums each title's share.
+# Normalizing the sum gives the same direction as the average
+def getTitleVectors(titles):
+  if len(titleVectors) > TITLE_CACHE_SIZE:
+    titleVectors.clear()
+  newTitles = [title for title in dict.fromkeys(titles) if title not in titleVectors]
+  if newTitles:
+    rowsPerTitle = [titleRows(title) for title in newTitles]
+    counts = np.array([len(rows) for rows in rowsPerTitle])
+    starts = np.cumsum(counts) - counts
+    newVectors = np.zeros((len(newTitles), VECTOR_TABLE.shape[1]), dtype=np.float16)
+    # Titles with no known words have no rows and keep a zero vector
+    known = counts > 0
+    if known.any():
+      allRows = [row for rows in rowsPerTitle for row in rows]
+      rows = VECTOR_TABLE[allRows] * VECTOR_SCALES[allRows, None]
+      sums = np.add.reduceat(rows, starts[known])
+      norms = np.linalg.norm(sums, axis=1, keepdims=True)
+      newVectors[known] = sums / np.maximum(norms, 1e-9)
+    for title, vector in zip(newTitles, newVectors):
+      titleVectors[title] = vector
+  # numpy has no fast float16 matmul, so score in float32
+  return np.vstack([titleVectors[title] for title in titles]).astype(np.float32)
+
+# The API takes up to this many titles in one query
+API_TITLE_LIMIT = 50
+
+# Asks the MediaWiki API for the article links on Wikipedia pages
+# and returns {url: [(link URL, link title), ...]}. The API sends
+# just the link lists as JSON, so there's no full HTML page to
+# download and parse, and pages are looked up 50 at a time
+def fetchLinksBatch(urls):
+  links = readCachedLinks(urls)
+  missing = [url for url in dict.fromkeys(urls) if url not in links]
+
+  for i in range(0, len(missing), API_TITLE_LIMIT):
+    batch = missing[i:i + API_TITLE_LIMIT]
+    titleURLs = {}
+    for url in batch:
+      titleURLs.setdefault(urlToTitle(url), []).append(url)
+    params = {
+      "action": "query",
+      "format": "json",
+      # Version 2 drops the page-id keyed objects for plain lists,
+      # which makes for smaller responses
+      "formatversion": 2,
+      "prop": "links",
+      "titles": "|".join(titleURLs),
+      # Namespace 0 is the main articles, which leaves out
+      # talk pages, categories, files, templates, etc.
+      "plnamespace": 0,
+      "pllimit": "max",
+      "redirects": 1,
+    }
+    # 3a. Collect links
+    for url in batch:
+      links[url] = []
+    while True:
+      waitForRequestSlot()
+      response = SESSION.get(API_URL, params=params, timeout=10)
+      response.raise_for_status()
+      data = response.json()
+      if "error" in data:
+        raise RuntimeError("MediaWiki API error: " + data["error"].get("info", ""))
+      query = data["query"]
+      # The API answers with the normalized, redirected title
+      # ("big bang" -> "Big Bang"), so follow our titles along
+      for renamed in query.get("normalized", []) + query.get("redirects", []):
+        if renamed["from"] in titleURLs:
+          titleURLs.setdefault(renamed["to"], []).extend(titleURLs.pop(renamed["from"]))
+      for page in query["pages"]:
+        pageLinks = []
+        for link in page.get("links", []):
+          title = link["title"]
+          pageLinks.append((titleToURL(title), title))
+        for url in titleURLs.get(page["title"], []):
+          links[url].extend(pageLinks)
+      # Links are sent at most 500 at a time across the whole batch,
+      # so large pages come back in several parts
+      if "continue" not in data:
+        break
+      params.update(data["continue"])
+
+    writeCachedLinks({url: links[url] for url in batch})
+  return links
+
+# Same as fetchLinksBatch for a single page. Repeat lookups are served
+# by the disk cache, which also makes sure they expire
+def fetchLinks(url):
+  return fetchLinksBatch([url])[url]
+
+# Looks up the links of every page within depth hops of startURL
+# ahead of time and stores them in the link cache, so traversals
+# starting there later read those pages without any requests.
+# depth=1 caches startURL and every page it links to. A hub page
+# links to hundreds of others, so at most maxPages pages are cached
+def precrawl(startURL, depth=1, maxPages=1000):
+  startURL = titleToURL(urlToTitle(startURL))
+  frontier = [startURL]
+  seen = {startURL}
+  for level in range(depth):
+    nextFrontier = []
+    for pageLinks in fetchLinksBatch(frontier).values():
+      for linkURL, _ in pageLinks:
+        if len(seen) >= maxPages:
+          break
+        if linkURL not in seen:
+          seen.add(linkURL)
+          nextFrontier.append(linkURL)
+    frontier = nextFrontier
+  # The last level is only fetched, its links aren't followed
+  fetchLinksBatch(frontier)
 
 # startURL: https://en.wikipedia.org/wiki/XXXXX
 # targetURL: https://en.wikipedia.org/wiki/YYYYY
@@ -9,13 +265,17 @@ from time import sleep
 # pages the program will search
 # Returns 1 if a path is found, 0 if not
 def traverseWiki(startURL, targetURL, limit=10):
-  nlp = spacy.load("en_core_web_lg")
-  # Parse the targetURL for the semantic meaning of the title
-  targetTitle = targetURL.rsplit('/', 1)[-1].replace("_", " ")
-  targetSemantic = nlp(targetTitle)
+  # Parse the targetURL for the semantic meaning of the title, and
+  # respell both URLs the way link URLs are built so they compare equal
+  targetTitle = urlToTitle(targetURL)
+  targetURL = titleToURL(targetTitle)
+  startURL = titleToURL(urlToTitle(startURL))
+  targetVector = getTitleVectors([targetTitle])[0]
   currentURL = startURL
-  # Path keeps track of the pages we ultimately visit
+  # Path keeps track of the pages we ultimately visit,
+  # visited holds the same pages for fast lookups
   path = [currentURL]
+  visited = {currentURL}
 
   for i in range(limit):
     # 1. Determine if current URL is the target URL
@@ -25,48 +285,39 @@ def traverseWiki(startURL, targetURL, limit=10):
       return 1
     
     # 2. Go to valid URL
-    response = requests.get(
-      url=currentURL,
-    )
-    soup = BeautifulSoup(response.content, 'html.parser')
+    allLinks = fetchLinks(currentURL)
+    candidateURLs = []
+    candidateTitles = []
 
-    # 3a. Collect links
-    allLinks = soup.find(id="bodyContent").find_all("a")
-    semanticSimilarity = 0
-
-    for link in allLinks:
-      # 3b. Sort out the 'bad' links
-      # (non-Wiki references, non-main articles)
-      linkHref = link.get('href', "")
-      if linkHref.find("/wiki/") == -1:
-        continue
-      if ((linkHref.find("/Special:") != -1) or 
-          (linkHref.find("/Talk:") != -1) or 
-          (linkHref.find("/Category:") != -1) or 
-          (linkHref.find("/File:") != -1) or
-          (linkHref.find("/Wikipedia:") != -1) or
-          (linkHref.find("/Template:") != -1) or
-          (linkHref.find("wikidata") != -1) or
-          (linkHref.find("/Help:") != -1)):
-        continue
-      linkURL = "https://en.wikipedia.org" + linkHref
+    for linkURL, linkTitle in allLinks:
+      # 3b. If the target is linked from this page we're done,
+      # without scoring any of the links. Returning here also counts
+      # a target found on the last page the limit allows
+      if linkURL == targetURL:
+        path.append(targetURL)
+        print("Success!")
+        print(path)
+        return 1
       # 3c. In order to prevent loops, I prevent the
       # program from looking at links to pages
       # we've already traversed
-      if linkURL in path:
+      if linkURL in visited:
         continue
-      # 4. Parsing links for article titles
-      currentTitle = linkURL.rsplit('/', 1)[-1].replace("_", " ")
-      # 5a. Run a semantic comparison on each article title with the target article title
-      currentSemantic = nlp(currentTitle)
-      similarity = targetSemantic.similarity(currentSemantic)
-      # 5b/6. Keep track (and eventually go to) the page with the highest semantic similarity
-      if similarity > semanticSimilarity:
-        print("Most similar changed to " + currentTitle)
-        semanticSimilarity = similarity
-        currentURL = linkURL
+      # 4. Article titles come with the links, no need to parse the URL
+      candidateURLs.append(linkURL)
+      candidateTitles.append(linkTitle)
+
+    # 5a. Run a semantic comparison on every article title with the
+    # target article title at once. The vectors all have length 1,
+    # so their cosine similarities are a single matrix-vector product
+    if candidateURLs:
+      scores = getTitleVectors(candidateTitles) @ targetVector
+      # 5b/6. Go to the page with the highest semantic similarity
+      best = int(scores.argmax())
+      print("Most similar is " + candidateTitles[best])
+      currentURL = candidateURLs[best]
     path.append(currentURL)
-    sleep(1)
+    visited.add(currentURL)
 
 
   print("Failure! Traversal limit exceeded!")
@@ -75,3 +326,5 @@ def traverseWiki(startURL, targetURL, limit=10):
 
 # Example of use:
 # traverseWiki("https://en.wikipedia.org/wiki/Big_Bang", "https://en.wikipedia.org/wiki/Taylor_Swift", 10)
+# To cache the neighborhood of a start page beforehand:
+# precrawl("https://en.wikipedia.org/wiki/Big_Bang", 1, 1000)